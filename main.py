@@ -2,6 +2,12 @@ import sys
 import random
 import json
 import os
+import gzip
+import time
+import hashlib
+import base64
+import threading
+from collections import deque
 from PyQt6.QtWidgets import (QApplication, QWidget, QLabel, QMenu, 
                              QSystemTrayIcon, QInputDialog, QLineEdit,
                              QVBoxLayout, QPushButton, QHBoxLayout,
@@ -20,6 +26,202 @@ WINDOW_WIDTH = 120
 WINDOW_HEIGHT = 160 # 包含气泡的空间
 CONFIG_FILE = "config.json"
 HISTORY_FILE = "history.json"
+TRANSPORT_FILE = "transport_log.jsonl"
+DEFAULT_PROMPT = "你是一个可爱的桌宠。"
+HISTORY_WINDOW = 10 # 发送给 AI 的历史消息条数（按块滑动，实际为 10~19 条）
+
+# -----------------------------------------------------------------------------
+# 网络传输层（live / record / replay）
+# -----------------------------------------------------------------------------
+def _request_key(method, url, data):
+    """请求的匹配键：方法 + URL + 请求体摘要（不包含 API Key 等请求头）"""
+    digest = hashlib.sha256(data or b"").hexdigest()
+    return f"{method.upper()} {url} {digest}"
+
+def _encode_request_body(data):
+    """把请求体转成可写入录制文件的字段：JSON 直接保存，其余（如 gzip）保存为 base64"""
+    if not data:
+        return {}
+    try:
+        return {"body": json.loads(data)}
+    except (ValueError, UnicodeDecodeError):
+        return {"body_base64": base64.b64encode(data).decode("ascii")}
+
+class LiveTransport:
+    """直接通过 requests 发送真实网络请求"""
+    def request(self, method, url, headers=None, data=None, timeout=30):
+        return requests.request(method, url, headers=headers, data=data, timeout=timeout)
+
+class RecordTransport(LiveTransport):
+    """发送真实请求，同时把请求体、响应内容和耗时追加写入文件（不记录请求头）"""
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def request(self, method, url, headers=None, data=None, timeout=30):
+        entry = {"key": _request_key(method, url, data)}
+        entry.update(_encode_request_body(data))
+        start = time.perf_counter()
+        try:
+            response = super().request(method, url, headers=headers, data=data, timeout=timeout)
+        except Exception as e:
+            entry["elapsed"] = time.perf_counter() - start
+            entry["error"] = str(e)
+            self._append(entry)
+            raise
+        entry["elapsed"] = time.perf_counter() - start
+        entry["status_code"] = response.status_code
+        entry["text"] = response.text
+        self._append(entry)
+        return response
+
+    def _append(self, entry):
+        with self._lock:
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+
+class ReplayResponse:
+    """回放用的响应对象，只实现本程序用到的接口"""
+    def __init__(self, status_code, text):
+        self.status_code = status_code
+        self.text = text
+        self.content = text.encode("utf-8")
+
+    def json(self):
+        return json.loads(self.text)
+
+class ReplayTransport:
+    """从录制文件回放响应，按原始耗时（乘以 time_scale）等待后返回
+
+    优先匹配请求体完全一致的录制记录；请求体不同时（例如 history.json 已变化），
+    按录制顺序取同一方法 + URL 的下一条记录。全部用完时抛出连接异常。
+    """
+    def __init__(self, path, time_scale=1.0):
+        self.path = path
+        self.time_scale = time_scale
+        self._lock = threading.Lock()
+        self._by_key = {}
+        self._by_endpoint = {}
+        self._entries = []
+        self.file_missing = not os.path.exists(path)
+        if self.file_missing:
+            print(f"警告: 录制文件 {path} 不存在，所有回放请求都会失败")
+        else:
+            self._load(path)
+
+    def _load(self, path):
+        """读取录制文件，跳过损坏或格式不对的行（例如录制中途被强制退出）"""
+        skipped = 0
+        try:
+            with open(path, "r", encoding="utf-8", errors="replace") as f:
+                for line in f:
+                    line = line.strip()
+                    if not line:
+                        continue
+                    entry = self._parse_entry(line)
+                    if entry is None:
+                        skipped += 1
+                        continue
+                    self._entries.append(entry)
+                    self._by_key.setdefault(entry["key"], deque()).append(entry)
+                    endpoint = entry["key"].rsplit(" ", 1)[0]
+                    self._by_endpoint.setdefault(endpoint, deque()).append(entry)
+        except OSError as e:
+            print(f"回放: 无法读取录制文件 {path}: {e}")
+        if skipped:
+            print(f"回放: 跳过了 {path} 中 {skipped} 行无效记录")
+
+    @staticmethod
+    def _parse_entry(line):
+        """解析并校验一行录制记录，无效时返回 None"""
+        try:
+            entry = json.loads(line)
+            if not isinstance(entry, dict) or not isinstance(entry["key"], str) \
+                    or len(entry["key"].split(" ")) != 3:
+                return None
+            entry["elapsed"] = float(entry.get("elapsed", 0))
+        except (ValueError, KeyError, TypeError):
+            return None
+        if "error" in entry:
+            entry["error"] = str(entry["error"])
+        elif not (isinstance(entry.get("status_code"), int) and isinstance(entry.get("text"), str)):
+            return None
+        # NaN、负数、无穷大都视为无效
+        if not 0 <= entry["elapsed"] < float("inf"):
+            return None
+        entry["used"] = False
+        return entry
+
+    @staticmethod
+    def _take(queue):
+        """取出队列中第一条未使用的记录"""
+        while queue:
+            entry = queue.popleft()
+            if not entry["used"]:
+                entry["used"] = True
+                return entry
+        return None
+
+    def _closest_candidate(self, url):
+        """未命中时给出最接近的未使用记录：优先同一 URL，其次录制顺序中的下一条"""
+        remaining = [e for e in self._entries if not e["used"]]
+        for entry in remaining:
+            if entry["key"].split(" ")[1] == url:
+                return entry
+        return remaining[0] if remaining else None
+
+    def request(self, method, url, headers=None, data=None, timeout=30):
+        key = _request_key(method, url, data)
+        with self._lock:
+            entry = self._take(self._by_key.get(key))
+            if entry is None:
+                entry = self._take(self._by_endpoint.get(key.rsplit(" ", 1)[0]))
+                if entry is not None:
+                    print(f"回放: 请求体与录制不一致，按录制顺序使用 {entry['key']}")
+            candidate = self._closest_candidate(url) if entry is None else None
+        if entry is None:
+            if self.file_missing:
+                # 气泡只显示前 50 个字符，把原因放在最前面
+                raise requests.exceptions.ConnectionError(f"录制文件 {self.path} 不存在，无法回放: {method.upper()} {url}")
+            if candidate is None:
+                detail = "录制记录已全部回放"
+            else:
+                detail = f"最接近的录制: {candidate['key']}"
+                print(f"回放未命中，录制请求体: {json.dumps(candidate.get('body', candidate.get('body_base64')), ensure_ascii=False)}")
+            print(f"回放未命中，当前请求体: {json.dumps(_encode_request_body(data), ensure_ascii=False)}")
+            raise requests.exceptions.ConnectionError(f"回放记录中没有该请求: {method.upper()} {url}，{detail}")
+
+        delay = entry.get("elapsed", 0) * self.time_scale
+        # 超过 timeout 的录制按超时处理，与真实请求的行为保持一致
+        if delay > timeout:
+            time.sleep(timeout)
+            raise requests.exceptions.Timeout(f"回放超时 ({timeout}s)")
+        time.sleep(delay)
+
+        if "error" in entry:
+            raise requests.exceptions.ConnectionError(entry["error"])
+        return ReplayResponse(entry["status_code"], entry["text"])
+
+def make_transport(config):
+    """根据配置创建传输层：transport_mode 可选 live / record / replay（不区分大小写）"""
+    raw_mode = config.get("transport_mode", "live")
+    mode = str(raw_mode).strip().lower()
+    path = config.get("transport_file", TRANSPORT_FILE)
+    if mode == "record":
+        return RecordTransport(path)
+    if mode == "replay":
+        try:
+            time_scale = float(config.get("replay_time_scale", 1.0))
+        except (ValueError, TypeError):
+            time_scale = -1.0
+        # NaN、负数、无穷大都视为无效；仍保持回放模式，避免离线会话意外联网
+        if not 0 <= time_scale < float("inf"):
+            print(f"警告: replay_time_scale 无效 ({config.get('replay_time_scale')!r})，按 1.0 回放")
+            time_scale = 1.0
+        return ReplayTransport(path, time_scale)
+    if mode != "live":
+        print(f"警告: 未知的 transport_mode ({raw_mode!r})，可选 live / record / replay，已使用联网模式")
+    return LiveTransport()
 
 # -----------------------------------------------------------------------------
 # AI 对话线程
@@ -28,31 +230,16 @@ class AIWorker(QThread):
     """异步处理 AI 请求的线程"""
     finished = pyqtSignal(str)
 
-    def __init__(self, api_url, api_key, model, prompt, messages):
+    def __init__(self, api_url, headers, body, transport=None):
         super().__init__()
         self.api_url = api_url
-        self.api_key = api_key
-        self.model = model
-        self.prompt = prompt
-        self.messages = messages
+        self.headers = headers
+        self.body = body # 已由 PayloadBuilder 编码好的请求体 (bytes)
+        self.transport = transport or LiveTransport()
 
     def run(self):
         try:
-            headers = {
-                "Authorization": f"Bearer {self.api_key}",
-                "Content-Type": "application/json"
-            }
-            
-            # 构建对话内容
-            full_messages = [{"role": "system", "content": self.prompt}] + self.messages
-            
-            payload = {
-                "model": self.model,
-                "messages": full_messages,
-                "stream": False
-            }
-            
-            response = requests.post(self.api_url, headers=headers, json=payload, timeout=30)
+            response = self.transport.request("POST", self.api_url, headers=self.headers, data=self.body, timeout=30)
             if response.status_code == 200:
                 result = response.json()
                 content = result["choices"][0]["message"]["content"]
@@ -66,6 +253,100 @@ class AIWorker(QThread):
         except Exception as e:
             self.finished.emit(f"网络异常: {str(e)[:50]}...")
 
+# -----------------------------------------------------------------------------
+# 请求体构建（预编码 + 稳定前缀）
+# -----------------------------------------------------------------------------
+def _encode_json(obj):
+    """紧凑 JSON 编码为 UTF-8 bytes"""
+    return json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+class PayloadBuilder:
+    """缓存已编码的请求前缀和历史消息，每次只编码新增的对话轮次
+
+    配合 context_window 按块截取历史：同一块内的连续请求只在末尾追加新消息，
+    前面的 system 提示词和历史消息逐字节不变，便于服务端命中前缀缓存。
+    """
+    MAX_CACHED_MESSAGES = 64
+
+    def __init__(self):
+        self._config_key = None
+        self._prefix = b""
+        self._headers = {}
+        self._gzip_min_bytes = 0
+        self._message_cache = {}
+
+    def _compile(self, config):
+        """配置变化时重新编译提示词模板和请求前缀"""
+        raw_prompt = config.get("prompt", DEFAULT_PROMPT)
+        pet_name = config.get("pet_name", "桌宠")
+        model = config.get("model", "gpt-3.5-turbo")
+        api_key = config.get("api_key", "")
+        raw_gzip_min_bytes = config.get("gzip_min_bytes", 0)
+        key = (raw_prompt, pet_name, model, api_key, repr(raw_gzip_min_bytes))
+        if key == self._config_key:
+            return
+
+        try:
+            gzip_min_bytes = int(raw_gzip_min_bytes or 0)
+        except (ValueError, TypeError):
+            print(f"警告: gzip_min_bytes 无效 ({raw_gzip_min_bytes!r})，已关闭 gzip 压缩")
+            gzip_min_bytes = 0
+
+        # 替换 {char} 占位符，只在配置变化时做一次
+        system_message = {"role": "system", "content": raw_prompt.replace("{char}", pet_name)}
+        self._prefix = (b'{"model":' + _encode_json(model)
+                        + b',"stream":false,"messages":['
+                        + _encode_json(system_message))
+        self._headers = {
+            "Authorization": f"Bearer {api_key}",
+            "Content-Type": "application/json"
+        }
+        self._gzip_min_bytes = gzip_min_bytes
+        self._config_key = key
+
+    def _encode_message(self, msg):
+        """编码单条历史消息，命中缓存时直接复用"""
+        key = (msg["role"], msg["content"])
+        encoded = self._message_cache.get(key)
+        if encoded is None:
+            encoded = _encode_json({"role": msg["role"], "content": msg["content"]})
+            self._message_cache[key] = encoded
+        return encoded
+
+    @staticmethod
+    def context_window(history, size=HISTORY_WINDOW):
+        """截取发送给 AI 的历史消息
+
+        起点按 size 条为一块对齐，而不是每轮都取最近 size 条：
+        逐轮滑动会让每次请求在 system 提示词之后就不同，前缀缓存无法命中。
+        """
+        if len(history) <= size:
+            return history
+        start = (len(history) - size) // size * size
+        return history[start:]
+
+    def build(self, config, messages):
+        """返回 (body, headers)，body 为可直接发送的 bytes"""
+        self._compile(config)
+        parts = [self._prefix]
+        for msg in messages:
+            parts.append(b",")
+            parts.append(self._encode_message(msg))
+        parts.append(b"]}")
+        body = b"".join(parts)
+
+        # 只保留当前窗口内的消息缓存，避免无限增长
+        if len(self._message_cache) > self.MAX_CACHED_MESSAGES:
+            live = {(m["role"], m["content"]) for m in messages}
+            self._message_cache = {k: v for k, v in self._message_cache.items() if k in live}
+
+        headers = dict(self._headers)
+        # 可选：较大的请求体使用 gzip 压缩（需要服务端支持 Content-Encoding）
+        if self._gzip_min_bytes > 0 and len(body) >= self._gzip_min_bytes:
+            body = gzip.compress(body, mtime=0)
+            headers["Content-Encoding"] = "gzip"
+        return body, headers
+
 # -----------------------------------------------------------------------------
 # 历史对话查看器
 # -----------------------------------------------------------------------------
@@ -105,11 +386,12 @@ from PyQt6.QtWidgets import QComboBox, QMessageBox
 
 class ConfigDialog(QDialog):
     """配置 AI API 和 Prompt 的对话框"""
-    def __init__(self, parent=None, config=None):
+    def __init__(self, parent=None, config=None, transport=None):
         super().__init__(parent)
         self.setWindowTitle("AI 桌宠配置")
         self.setFixedSize(450, 400)
         self.config = config or {}
+        self.transport = transport or LiveTransport()
         
         layout = QVBoxLayout()
         
@@ -145,7 +427,7 @@ class ConfigDialog(QDialog):
         # Prompt
         layout.addWidget(QLabel("角色提示词 (System Prompt):"))
         self.prompt_input = QTextEdit()
-        self.prompt_input.setPlainText(self.config.get("prompt", "你是一个可爱的桌宠。"))
+        self.prompt_input.setPlainText(self.config.get("prompt", DEFAULT_PROMPT))
         layout.addWidget(self.prompt_input)
         
         # 按钮
@@ -182,7 +464,7 @@ class ConfigDialog(QDialog):
                 models_url = f"{base_url}/models"
                 
             headers = {"Authorization": f"Bearer {api_key}"}
-            response = requests.get(models_url, headers=headers, timeout=10)
+            response = self.transport.request("GET", models_url, headers=headers, timeout=10)
             
             if response.status_code == 200:
                 data = response.json()
@@ -277,6 +559,7 @@ class DesktopPet(QWidget):
         self.bubble_text = ""
         self.scroll_offset = 0 # 文字滚动偏移
         self.chat_history = self.load_history()
+        self.payload_builder = PayloadBuilder()
 
     def init_ui(self):
         """初始化窗口属性"""
@@ -345,6 +628,8 @@ class DesktopPet(QWidget):
                 self.config["pet_name"] = "萌萌"
             self.save_config()
 
+        self.transport = make_transport(self.config)
+
     def init_tray(self):
         """初始化系统托盘"""
         self.tray_icon = QSystemTrayIcon(self)
@@ -586,17 +871,12 @@ class DesktopPet(QWidget):
         # 添加到历史
         self.chat_history.append({"role": "user", "content": text})
         
-        # 准备 Prompt（替换 {char} 占位符）
-        raw_prompt = self.config.get("prompt", "你是一个可爱的桌宠。")
-        pet_name = self.config.get("pet_name", "桌宠")
-        final_prompt = raw_prompt.replace("{char}", pet_name)
+        # 构建请求体（Prompt 模板和历史消息的编码结果会被缓存复用）
+        messages = PayloadBuilder.context_window(self.chat_history)
+        body, headers = self.payload_builder.build(self.config, messages)
 
         # 启动线程
-        self.worker = AIWorker(self.config["api_url"], 
-                               self.config["api_key"], 
-                               self.config.get("model", "gpt-3.5-turbo"),
-                               final_prompt, 
-                               self.chat_history[-10:]) # 取最近 10 条
+        self.worker = AIWorker(self.config["api_url"], headers, body, self.transport)
         self.worker.finished.connect(self.on_ai_finished)
         self.worker.start()
 
@@ -637,10 +917,16 @@ class DesktopPet(QWidget):
         dialog.exec()
 
     def show_config_dialog(self):
-        dialog = ConfigDialog(self, self.config)
+        dialog = ConfigDialog(self, self.config, self.transport)
         if dialog.exec():
-            self.config = dialog.get_config()
+            transport_keys = ("transport_mode", "transport_file", "replay_time_scale")
+            old_transport_config = [self.config.get(k) for k in transport_keys]
+            # 合并而不是覆盖，保留昵称等对话框之外的配置项
+            self.config.update(dialog.get_config())
             self.save_config()
+            # 只在传输配置变化时重建，避免回放进度被重置
+            if [self.config.get(k) for k in transport_keys] != old_transport_config:
+                self.transport = make_transport(self.config)
 
     def save_config(self):
         """保存配置到文件"""